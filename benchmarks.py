@@ -0,0 +1,271 @@
+import random
+import os, sys, getopt
+import json, time, platform, subprocess
+from timeit import default_timer
+from cStringIO import StringIO
+
+import commitments
+from commitments import make_vocabulary, regula_generator, policies_generator, interaction_generator, constructive_interaction_generator, precision_recall, Student, Agent, InteractionState
+
+
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**# Benchmarks #**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+
+# Each benchmark is a pair of functions: setup(voc, bound) builds the inputs
+# (it is not timed) and run(*inputs) is the code that is timed
+
+PARAMS = {'p0': 3,'p1': 3,'p2': 1,'p3': 200,'p4': 20,'p5': 2,'p6': 0.8, 'ep': 10, 'epp': 30}
+SPECS = 20
+INTERACTIONS = 50
+WARMUP = 50
+
+
+def make_params(vocab):
+	params = dict(PARAMS)
+	params['ep2'] = 2.0/len(vocab)
+	return params
+
+def make_policy(regula):
+	spolicy = len([c for c in regula if regula[c].operation=='create'])
+	try:
+		return policies_generator(regula, spolicy, 1)
+	except IndexError:
+		# with small vocabularies there may be no word left for a restriction
+		return {}
+
+def make_interactions(regula, vocab, bound, policy, n):
+	return [interaction_generator(regula, vocab, bound, policy, 1) for i in range(n)]
+
+def trained_student(regula, vocab, bound, policy):
+	st = Student(make_params(vocab))
+	for interaction, guilty_canc in make_interactions(regula, vocab, bound, policy, WARMUP):
+		st.learn_puncanc(interaction, policy, guilty_canc)
+	return st
+
+
+def setup_regula(voc, bound):
+	return (make_vocabulary(voc),)
+
+def run_regula(vocab):
+	for i in range(SPECS):
+		regula_generator(vocab)
+
+def setup_policies(voc, bound):
+	vocab = make_vocabulary(voc)
+	return ([regula_generator(vocab) for i in range(SPECS)],)
+
+def run_policies(regulas):
+	for regula in regulas:
+		make_policy(regula)
+
+def setup_interactions(voc, bound):
+	vocab = make_vocabulary(voc)
+	regula = regula_generator(vocab)
+	return regula, vocab, bound, make_policy(regula)
+
+def run_interactions(regula, vocab, bound, policy):
+	make_interactions(regula, vocab, bound, policy, INTERACTIONS)
+
+def run_constructive(regula, vocab, bound, policy):
+	for i in range(INTERACTIONS):
+		constructive_interaction_generator(regula, vocab, bound, policy, 1)
+
+def setup_learn(voc, bound):
+	vocab = make_vocabulary(voc)
+	regula = regula_generator(vocab)
+	policy = make_policy(regula)
+	st = trained_student(regula, vocab, bound, policy)
+	return st, make_interactions(regula, vocab, bound, policy, INTERACTIONS), policy
+
+def run_learn_release(st, interactions, policy):
+	for interaction, guilty_canc in interactions:
+		st.learn_release(interaction, policy)
+
+def run_learn_puncanc(st, interactions, policy):
+	for interaction, guilty_canc in interactions:
+		st.learn_puncanc(interaction, policy, guilty_canc)
+
+def setup_precision(voc, bound):
+	vocab = make_vocabulary(voc)
+	regula = regula_generator(vocab)
+	st = trained_student(regula, vocab, bound, {})
+	return regula, st
+
+def run_precision(regula, st):
+	for i in range(INTERACTIONS):
+		precision_recall(regula, st.alignment, PARAMS['epp'])
+
+def setup_choose(voc, bound):
+	vocab = make_vocabulary(voc)
+	regula = regula_generator(vocab)
+	agents = []
+	for i in range(INTERACTIONS):
+		interaction, guilty_canc = interaction_generator(regula, vocab, bound, {}, 1)
+		agent = Agent(1, regula)
+		agent.state = InteractionState(regula, interaction[:random.randint(0, bound-1)])
+		agent.interaction = agent.state.interaction
+		agents.append(agent)
+	return agents, bound
+
+def run_choose(agents, bound):
+	for agent in agents:
+		agent.choose_utterance(bound)
+
+def run_experiment1(voc):
+	commitments.experiment1(voc, 1, 20, 100)
+
+def run_experiment2(voc, type):
+	commitments.experiment2(2, 100, voc, type, 1)
+
+
+MICRO = [
+	('regula_generator', setup_regula, run_regula, False),
+	('policies_generator', setup_policies, run_policies, False),
+	('interaction_generator', setup_interactions, run_interactions, True),
+	('constructive_interaction_generator', setup_interactions, run_constructive, True),
+	('Student.learn_release', setup_learn, run_learn_release, True),
+	('Student.learn_puncanc', setup_learn, run_learn_puncanc, True),
+	('precision_recall', setup_precision, run_precision, True),
+	('Agent.choose_utterance', setup_choose, run_choose, True),
+]
+
+MACRO = [
+	('experiment1', lambda voc: (voc,), run_experiment1),
+	('experiment2-basic', lambda voc: (voc, 'basic'), run_experiment2),
+	('experiment2-punish', lambda voc: (voc, 'punish'), run_experiment2),
+	('experiment2-policy', lambda voc: (voc, 'policy'), run_experiment2),
+]
+
+
+def measure(setup, run, repeat, seed):
+	"""Times run over repeat fresh setups. Every repetition is seeded from seed"""
+	times = []
+	for r in range(repeat):
+		random.seed(seed + r)
+		inputs = setup()
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			start = default_timer()
+			run(*inputs)
+			times.append(default_timer() - start)
+		finally:
+			sys.stdout = stdout
+	times.sort()
+	return {'min': times[0], 'median': times[len(times)/2], 'mean': sum(times)/len(times), 'repeat': repeat}
+
+
+def run_benchmarks(vocs, bounds, repeat, seed, only=None, macro=True):
+	results = []
+	for name, setup, run, uses_bound in MICRO:
+		if only and not any(o in name for o in only):
+			continue
+		for voc in vocs:
+			for bound in (bounds if uses_bound else [None]):
+				result = measure(lambda: setup(voc, bound), run, repeat, seed)
+				result.update({'name': name, 'kind': 'micro', 'voc': voc, 'bound': bound})
+				sys.stderr.write('{name} voc={voc} bound={bound}: {min:.4f}s\n'.format(**result))
+				results.append(result)
+	if macro:
+		for name, setup, run in MACRO:
+			if only and not any(o in name for o in only):
+				continue
+			for voc in vocs:
+				try:
+					result = measure(lambda: setup(voc), run, repeat, seed)
+				except IndexError:
+					# as in make_policy, small vocabularies may leave no word for a restriction
+					results.append({'name': name, 'kind': 'macro', 'voc': voc, 'bound': None, 'skipped': 'no policy can be generated'})
+					sys.stderr.write('{} voc={}: skipped, no policy can be generated\n'.format(name, voc))
+					continue
+				result.update({'name': name, 'kind': 'macro', 'voc': voc, 'bound': None})
+				sys.stderr.write('{name} voc={voc}: {min:.4f}s\n'.format(**result))
+				results.append(result)
+	return results
+
+
+def revision():
+	"""Returns the git commit of the working tree, if there is one"""
+	try:
+		with open(os.devnull, 'w') as devnull:
+			return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def compare(old, new):
+	"""Prints the speedup of each benchmark in new with respect to old"""
+	key = lambda r: (r['name'], r['voc'], r['bound'])
+	before = dict((key(r), r) for r in old['results'] if 'min' in r)
+	print '{:<36} {:>4} {:>5} {:>10} {:>10} {:>8}'.format('benchmark', 'voc', 'bound', 'old', 'new', 'speedup')
+	for r in new['results']:
+		if key(r) in before and 'min' in r:
+			o = before[key(r)]['min']
+			print '{:<36} {:>4} {:>5} {:>10.4f} {:>10.4f} {:>7.2f}x'.format(r['name'], r['voc'], r['bound'], o, r['min'], o/r['min'] if r['min'] else float('inf'))
+
+
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#* Main *#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+
+USAGE = ' -o output file (default stdout) \n -r repetitions of each benchmark \n -s seed \n -q quick sweep (voc 5, 10 and bounds 4, 10) \n -m micro benchmarks only \n -k comma separated names of the benchmarks to run \n -c old.json new.json: compare two results files '
+
+def main(argv):
+	vocs = [5,10,15,20,25]
+	bounds = [4,6,8,10]
+	repeat = 3
+	seed = 0
+	output = None
+	only = None
+	macro = True
+
+	try:
+		opts, args = getopt.getopt(argv,"ho:r:s:qmk:c",["output=","repetitions=","seed=","quick","micro","only=","compare"])
+	except getopt.GetoptError:
+		print USAGE
+		sys.exit(2)
+
+	for opt, arg in opts:
+		if opt == '-h':
+			print USAGE
+			sys.exit()
+		if opt in ("-c", "--compare"):
+			if len(args) != 2:
+				print USAGE
+				sys.exit(2)
+			with open(args[0]) as f:
+				old = json.load(f)
+			with open(args[1]) as f:
+				new = json.load(f)
+			compare(old, new)
+			return
+		if opt in ("-o", "--output"):
+			output = arg
+		if opt in ("-r", "--repetitions"):
+			repeat = int(arg)
+		if opt in ("-s", "--seed"):
+			seed = int(arg)
+		if opt in ("-q", "--quick"):
+			vocs = [5,10]
+			bounds = [4,10]
+		if opt in ("-m", "--micro"):
+			macro = False
+		if opt in ("-k", "--only"):
+			only = arg.split(',')
+
+	results = run_benchmarks(vocs, bounds, repeat, seed, only, macro)
+	report = {
+		'meta': {'revision': revision(), 'python': platform.python_version(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'seed': seed, 'repeat': repeat, 'vocs': vocs, 'bounds': bounds},
+		'results': results,
+	}
+	if output:
+		with open(output, 'w') as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+	else:
+		print json.dumps(report, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,220 @@
+import sys, getopt
+import json, threading
+import Queue, SocketServer
+
+import commitments
+from commitments import Student, Corpus, experiment_params, get_maxalg, guilty_cancels, word_name
+
+
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**# Service #**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+
+# The service reads records, one JSON object per line, from stdin or from the clients of a
+# local socket. An interaction is {"interaction": [[agent, word], ...]}, with "guilty": [agents]
+# if the student should learn it with the guilty cancels (learn_puncanc). A query is
+# {"query": "maxalg"}, {"query": "precision"} (if the specification is known) or
+# {"query": "status"}, and is answered with one JSON object per line
+
+
+class LearnerService(object):
+	"""A student that learns from interactions as they arrive.
+		The interactions wait in a bounded queue, so that whoever sends them waits when the
+		student falls behind, and a thread learns them in order. Queries can be made from any
+		thread, and wait at most for the interaction that is being learnt.
+		Only the words of vocab (those of the regula, if no vocab is given) are accepted"""
+
+	def __init__(self, params, regula=None, policy={}, size=100, backend='dict', topk=None, vocab=None):
+		self.student = Student(params, backend, topk)
+		self.regula = regula
+		if vocab is None and regula is not None:
+			vocab = regula.keys()
+		self.vocab = set(vocab) if vocab is not None else None
+		self.policy = policy
+		self.queue = Queue.Queue(size)
+		self.lock = threading.Lock()
+		self.learnt = 0
+		self.failed = 0
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, interaction, guilty_canc=None):
+		"""Queues an interaction, waiting while the queue is full"""
+		self.queue.put((interaction, guilty_canc))
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				return
+			interaction, guilty_canc = item
+			try:
+				with self.lock:
+					if guilty_canc is None:
+						self.student.learn_release(interaction, self.policy)
+					else:
+						self.student.learn_puncanc(interaction, self.policy, guilty_canc)
+					self.learnt += 1
+			except Exception as e:
+				self.failed += 1
+				sys.stderr.write('could not learn {}: {}\n'.format(interaction, e))
+			finally:
+				self.queue.task_done()
+
+	def join(self):
+		"""Waits until all the queued interactions are learnt"""
+		self.queue.join()
+
+	def close(self):
+		"""Learns the queued interactions and stops the thread"""
+		self.queue.put(None)
+		self.thread.join()
+
+	def query(self, what):
+		if what == 'status':
+			return {'learnt': self.learnt, 'failed': self.failed, 'queued': self.queue.qsize()}
+		with self.lock:
+			if what == 'maxalg':
+				maxalg = get_maxalg(self.student.alignment, self.student.params['epp']) or {}
+				return {'learnt': self.learnt, 'maxalg': dict((str(word_name(v)), str(c)) for v, c in maxalg.items())}
+			if what == 'precision':
+				if self.regula is None:
+					return {'error': 'the specification is not known'}
+				if any(not v in self.regula for v in self.student.alignment):
+					return {'error': 'some words are not in the specification'}
+				prec, rec, incorrect = self.student.precision_recall(self.regula, self.student.params['epp'])
+				return {'learnt': self.learnt, 'precision': prec, 'recall': rec,
+					'incorrect': dict((str(word_name(v)), [str(c) for c in pair]) for v, pair in incorrect.items())}
+		return {'error': 'unknown query {}'.format(what)}
+
+
+def handle_record(service, line):
+	"""Learns or answers the record in line. Returns the answer, if there is one"""
+	try:
+		record = json.loads(line)
+		if 'query' in record:
+			return service.query(record['query'])
+		interaction = [(int(a), int(w)) for a, w in record['interaction']]
+		if any(not a in (0, 1) for a, w in interaction):
+			raise ValueError('agents must be 0 or 1')
+		if service.vocab is not None and any(not w in service.vocab for a, w in interaction):
+			raise ValueError('unknown words {}'.format(sorted(set(w for a, w in interaction if not w in service.vocab))))
+		guilty_canc = record.get('guilty')
+		if guilty_canc is not None and (not isinstance(guilty_canc, list) or any(isinstance(a, bool) or not a in (0, 1) for a in guilty_canc)):
+			raise ValueError('guilty must be a list of agents 0 or 1')
+	except (ValueError, KeyError, TypeError) as e:
+		return {'error': 'invalid record: {}'.format(e)}
+	service.put(interaction, guilty_canc)
+
+
+class RecordHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		for line in iter(self.rfile.readline, ''):
+			if not line.strip():
+				continue
+			answer = handle_record(self.server.service, line)
+			if answer is not None:
+				self.wfile.write(json.dumps(answer) + '\n')
+				self.wfile.flush()
+
+class RecordServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	"""Serves each client in its own thread. A client sending interactions faster than they
+		are learnt waits on the queue, and so stops reading from its socket"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, service):
+		SocketServer.TCPServer.__init__(self, address, RecordHandler)
+		self.service = service
+
+
+def feed(corpus, guilty):
+	"""Writes the interactions of a corpus as records"""
+	for interaction in corpus:
+		record = {'interaction': interaction}
+		if guilty:
+			record['guilty'] = guilty_cancels(corpus.regula, interaction)
+		print json.dumps(record)
+
+
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#* Main *#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+
+USAGE = ' -c corpus whose specification, policy and word names are used \n -t type of experiment whose parameters are used: basic, punish, policy... \n -v vocabulary size, if there is no corpus \n -p port: serve the clients of a local socket instead of stdin \n -q size of the queue of interactions \n -f corpus: write the interactions of the corpus as records, instead of learning \n --backend dict or array \n --topk maximum number of candidates for each word '
+
+def main(argv):
+	corpus = None
+	type = 'basic'
+	voc = 10
+	port = None
+	size = 100
+	source = None
+	backend = 'dict'
+	topk = None
+
+	try:
+		opts, args = getopt.getopt(argv,"hc:t:v:p:q:f:",["corpus=","type=","voc=","port=","queue=","feed=","backend=","topk="])
+	except getopt.GetoptError:
+		print USAGE
+		sys.exit(2)
+
+	for opt, arg in opts:
+		if opt == '-h':
+			print USAGE
+			sys.exit()
+		if opt in ("-c", "--corpus"):
+			corpus = Corpus(arg)
+		if opt in ("-t", "--type"):
+			type = arg
+		if opt in ("-v", "--voc"):
+			voc = int(arg)
+		if opt in ("-p", "--port"):
+			port = int(arg)
+		if opt in ("-q", "--queue"):
+			size = int(arg)
+		if opt in ("-f", "--feed"):
+			source = Corpus(arg)
+		if opt == "--backend":
+			backend = arg
+		if opt == "--topk":
+			topk = int(arg)
+
+	if source is not None:
+		feed(source, type == 'punish')
+		return
+
+	if corpus is not None:
+		commitments.symbols.clear()
+		commitments.symbols.update(corpus.symbols)
+		vocab, regula, policy = corpus.regula.keys(), corpus.regula, corpus.policy
+	else:
+		vocab, regula, policy = range(voc), None, {}
+	params, limit = experiment_params(type, vocab, 0)
+	service = LearnerService(params, regula, policy, size, backend, topk, vocab)
+
+	if port is not None:
+		server = RecordServer(('localhost', port), service)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			server.server_close()
+		service.close()
+	else:
+		for line in iter(sys.stdin.readline, ''):
+			if not line.strip():
+				continue
+			answer = handle_record(service, line)
+			if answer is not None:
+				print json.dumps(answer)
+				sys.stdout.flush()
+		service.close()
+		print json.dumps(service.query('status'))
+		if regula is not None:
+			print json.dumps(service.query('precision'))
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,219 @@
+import random
+import os, sys, getopt
+import json, hashlib, itertools
+from multiprocessing import Pool
+
+from commitments import make_vocabulary, experiment_params, run_iteration_captured, BOUNDS
+
+
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**# Sweeps *#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+
+# A point of a sweep is an experiment type, a vocabulary size and the learning parameters
+# that replace those of experiment_params. Every point is evaluated as experiment2 does,
+# over the same iterations: with the same seed, all the points learn the same specifications
+# from the same interactions. The result of each point is kept in the cache directory, in
+# a file named after its configuration, so that an interrupted sweep can be run again
+
+PARAMETERS = ['p0','p1','p2','p3','p4','p5','p6','ep','epp','ep2']
+
+
+def parse_space(specs):
+	"""Parses the search space: each spec is name=v1,v2,... (the values to try)
+		or name=lo:hi (a range to sample from, only for random search)"""
+	space = {}
+	for spec in specs:
+		name, values = spec.split('=')
+		if not name in PARAMETERS:
+			raise ValueError("unknown parameter {}".format(name))
+		if ':' in values:
+			lo, hi = values.split(':')
+			space[name] = (float(lo), float(hi))
+		else:
+			space[name] = [float(v) for v in values.split(',')]
+	return space
+
+def grid(space):
+	"""All the combinations of the values in space"""
+	names = sorted(space)
+	if any(isinstance(space[n], tuple) for n in names):
+		raise ValueError("ranges can only be used in a random search")
+	return [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+
+def sample(space, n, rng):
+	"""n random points of space"""
+	names = sorted(space)
+	points = []
+	for k in range(n):
+		point = {}
+		for name in names:
+			if isinstance(space[name], tuple):
+				point[name] = rng.uniform(*space[name])
+			else:
+				point[name] = rng.choice(space[name])
+		points.append(point)
+	return points
+
+
+def point_key(config):
+	"""The name of the cache file of a configuration"""
+	return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()[:16]
+
+def evaluate(task):
+	"""Runs one iteration of a point, discarding what it prints"""
+	key, i, iteration = task
+	output, outcome = run_iteration_captured(iteration)
+	resultsTemp, convIt, prect, stats = outcome
+	return key, i, convIt, prect
+
+def summarize(config, conv, prec):
+	return {'config': config, 'conv': conv, 'precision': prec,
+		'mean_conv': sum(conv)/float(len(conv)), 'mean_precision': sum(prec)/float(len(prec))}
+
+
+def run_sweep(types, vocs, points, iterations, ints, times, seed, jobs=1, cache=None, generator='rejection', corpus=None, library=None):
+	"""Evaluates every point for every type and vocabulary size. Returns the summary of
+		each configuration, ranked by mean convergence and then by mean precision"""
+	results = []
+	pending = {}
+	tasks = []
+	for type in types:
+		for voc in vocs:
+			vocab = make_vocabulary(voc)
+			for point in points:
+				config = {'type': type, 'voc': voc, 'params': point, 'iterations': iterations,
+					'interactions': ints, 'times': times, 'generator': generator, 'seed': seed}
+				key = point_key(config)
+				if key in pending:
+					continue
+				if cache and os.path.exists(os.path.join(cache, key + '.json')):
+					with open(os.path.join(cache, key + '.json')) as f:
+						results.append(json.load(f))
+					continue
+				params, limit = experiment_params(type, vocab, ints)
+				params.update(point)
+				pending[key] = {'config': config, 'conv': [None]*iterations, 'precision': [None]*iterations, 'left': iterations}
+				for i in range(iterations):
+					tasks.append((key, i, (i, vocab, type, params, limit, ints, times, 'dict', seed, generator, corpus, 1, None, 0, None, library, BOUNDS)))
+
+	sys.stderr.write('{} configurations cached, {} to run\n'.format(len(results), len(pending)))
+	if cache and not os.path.isdir(cache):
+		os.makedirs(cache)
+	if corpus and not os.path.isdir(corpus):
+		os.makedirs(corpus)
+	if library and not os.path.isdir(library):
+		os.makedirs(library)
+
+	if jobs > 1:
+		pool = Pool(jobs)
+		outcomes = pool.imap_unordered(evaluate, tasks)
+	else:
+		outcomes = itertools.imap(evaluate, tasks)
+
+	for key, i, convIt, prect in outcomes:
+		p = pending[key]
+		p['conv'][i] = convIt
+		p['precision'][i] = prect
+		p['left'] -= 1
+		if not p['left']:
+			result = summarize(p['config'], p['conv'], p['precision'])
+			if cache:
+				path = os.path.join(cache, key + '.json')
+				with open(path + '.tmp', 'w') as f:
+					json.dump(result, f, sort_keys=True)
+				os.rename(path + '.tmp', path)
+			results.append(result)
+			sys.stderr.write('{} {}: conv {:.1f} precision {:.3f}\n'.format(key, json.dumps(p['config']['params'], sort_keys=True), result['mean_conv'], result['mean_precision']))
+
+	if jobs > 1:
+		pool.close()
+		pool.join()
+
+	results.sort(key=lambda r: (r['mean_conv'], -r['mean_precision']))
+	return results
+
+
+def print_table(results):
+	names = sorted(set(n for r in results for n in r['config']['params']))
+	print '{:>4} {:<10} {:>4} '.format('rank', 'type', 'voc') + ' '.join('{:>8}'.format(n) for n in names) + ' {:>10} {:>10}'.format('conv', 'precision')
+	for rank, r in enumerate(results):
+		config = r['config']
+		print '{:>4} {:<10} {:>4} '.format(rank+1, config['type'], config['voc']) + ' '.join('{:>8.4g}'.format(config['params'][n]) if n in config['params'] else '{:>8}'.format('-') for n in names) + ' {:>10.1f} {:>10.3f}'.format(r['mean_conv'], r['mean_precision'])
+
+
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#* Main *#**#**#**#**#**#**#**#**#**#**#
+#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#**#
+
+USAGE = ' -g name=v1,v2,... values of a learning parameter (p0-p6, ep, epp, ep2), or name=lo:hi with -n \n -n number of random points (default: the whole grid) \n -t comma separated experiment types \n -v comma separated vocabulary sizes \n -r iterations of each point \n -i number of interactions \n -j number of processes \n -s seed \n -c cache directory \n -d corpus directory \n -o output file (JSON) \n -l specification library directory \n --generator rejection or constructive '
+
+def main(argv):
+	specs = []
+	n = None
+	types = ['basic']
+	vocs = [10]
+	iterations = 5
+	ints = 200
+	times = 1
+	jobs = 1
+	seed = 0
+	cache = None
+	corpus = None
+	output = None
+	library = None
+	generator = 'rejection'
+
+	try:
+		opts, args = getopt.getopt(argv,"hg:n:t:v:r:i:j:s:c:d:l:o:",["grid=","random=","type=","voc=","repetitions=","interactions=","jobs=","seed=","cache=","corpus=","library=","output=","generator="])
+	except getopt.GetoptError:
+		print USAGE
+		sys.exit(2)
+
+	for opt, arg in opts:
+		if opt == '-h':
+			print USAGE
+			sys.exit()
+		if opt in ("-g", "--grid"):
+			specs.append(arg)
+		if opt in ("-n", "--random"):
+			n = int(arg)
+		if opt in ("-t", "--type"):
+			types = arg.split(',')
+		if opt in ("-v", "--voc"):
+			vocs = [int(v) for v in arg.split(',')]
+		if opt in ("-r", "--repetitions"):
+			iterations = int(arg)
+		if opt in ("-i", "--interactions"):
+			ints = int(arg)
+		if opt in ("-j", "--jobs"):
+			jobs = int(arg)
+		if opt in ("-s", "--seed"):
+			seed = int(arg)
+		if opt in ("-c", "--cache"):
+			cache = arg
+		if opt in ("-d", "--corpus"):
+			corpus = arg
+		if opt in ("-l", "--library"):
+			library = arg
+		if opt in ("-o", "--output"):
+			output = arg
+		if opt == "--generator":
+			generator = arg
+
+	try:
+		space = parse_space(specs)
+		points = sample(space, n, random.Random(seed)) if n else grid(space)
+	except ValueError as e:
+		print e
+		sys.exit(2)
+
+	results = run_sweep(types, vocs, points, iterations, ints, times, seed, jobs, cache, generator, corpus, library)
+	print_table(results)
+	if output:
+		with open(output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])